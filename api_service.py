@@ -3,19 +3,56 @@ Web Search Agent API 服务
 支持流式/非流式对话，用户会话管理
 """
 
-from fastapi import FastAPI, HTTPException
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException, Query, Request, Response
 from fastapi.datastructures import Headers
-from fastapi.responses import StreamingResponse
-from pydantic import BaseModel
-from typing import Optional, Dict, List, Any
-import json
+from fastapi.responses import JSONResponse, ORJSONResponse, StreamingResponse
+from pydantic import BaseModel, ConfigDict
+from typing import Optional, Dict, List, Set, Any, AsyncIterator, Callable, Tuple
+from logging.handlers import QueueHandler, QueueListener
+import asyncio
+import httpx
+import inspect
 import logging
+import json
+import queue
+import uuid
 
+from config import get_settings
 from llm import LLM
+from response_cache import ResponseCache
+from session_store import RedisSessionStore, SessionCache
 from tools import tool_functions, tools
 
-# 配置日志
-logging.basicConfig(level=logging.INFO)
+# JSON序列化：优先使用orjson，未安装时回退标准库json
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+if orjson is not None:
+    json_dumps = orjson.dumps
+    AppJSONResponse = ORJSONResponse
+else:
+    def json_dumps(obj: Any) -> bytes:
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode()
+    AppJSONResponse = JSONResponse
+
+class DeferredQueueHandler(QueueHandler):
+    """只把原始日志记录放入队列，格式化与输出都在监听线程中完成"""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+# 配置日志：默认直接输出；lifespan运行期间切换为队列，由后台线程格式化并写stdout，
+# 避免在事件循环中同步格式化和写入。
+# 监听线程在lifespan中按进程启动：gunicorn preload_app时导入发生在master，线程不会随fork进入worker；
+# 未运行lifespan时（脚本导入、--lifespan off）日志仍直接输出，不会积压在无人消费的队列中
+log_handler = logging.StreamHandler()
+log_handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+log_queue: queue.Queue = queue.Queue(-1)
+log_queue_handler = DeferredQueueHandler(log_queue)
+logging.basicConfig(level=logging.INFO, handlers=[log_handler])
 logger = logging.getLogger(__name__)
 
 # ============================================
@@ -27,6 +64,14 @@ logger = logging.getLogger(__name__)
 
 class ChatRequest(BaseModel):
     """聊天请求模型"""
+    model_config = ConfigDict(
+        frozen=True,
+        extra="forbid",
+        str_strip_whitespace=True,
+        validate_assignment=False,
+        revalidate_instances="never"
+    )
+
     user_id: str                          
     message: str                          
     stream: bool = False                  
@@ -35,7 +80,9 @@ class ChatRequest(BaseModel):
     max_tool_rounds: int = 3             # 工具调用次数
 
 class ChatResponse(BaseModel):
-    """非流式响应模型"""
+    """非流式响应模型（仅用于接口文档，响应由chat_response直接构建）"""
+    model_config = ConfigDict(frozen=True, revalidate_instances="never")
+
     user_id: str
     content: str                          
     conversation_history: List[Dict]      # 完整消息历史
@@ -45,114 +92,603 @@ class ChatResponse(BaseModel):
 # 应用初始化
 # ============================================
 
-app = FastAPI(title="Web Search Agent API")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """应用生命周期：启动/关闭时的资源管理"""
+    global session_store, http_client
 
-# 用户会话存储
-user_sessions: Dict[str, LLM] = {}
+    settings = get_settings()
 
-# LLM配置
-LLM_CONFIG = {
-    "api_key": "sk-f5889d58c6db4dd38ca78389a6c7a7e8",
-    "base_url": "https://api.deepseek.com/v1",
-    "model": "deepseek-chat"
-}
+    # 在当前进程（worker）中启动日志输出线程，并将根日志器切换为队列输出
+    root_logger = logging.getLogger()
+    log_listener = QueueListener(log_queue, log_handler)
+    log_listener.start()
+    root_logger.removeHandler(log_handler)
+    root_logger.addHandler(log_queue_handler)
+
+    # StreamingResponse会把同步生成器逐块放到线程池执行，流式链路必须保持全异步
+    if not inspect.isasyncgenfunction(LLM.chat_stream):
+        raise TypeError("LLM.chat_stream 必须是异步生成器")
+
+    # 确认事件循环实现（uvloop启动时应为 uvloop.Loop）
+    loop = asyncio.get_running_loop()
+    logger.info("Event loop: %s.%s", type(loop).__module__, type(loop).__name__)
+
+    # 所有会话共享一个HTTP连接池，复用与DeepSeek之间的TCP/TLS连接
+    http_client = httpx.AsyncClient(
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=50),
+        timeout=httpx.Timeout(60.0, connect=10.0)
+    )
+
+    # 定期清理空闲会话
+    sweep_task = asyncio.create_task(sweep_sessions())
+
+    # 配置了REDIS_URL时启用Redis会话存储，多worker共享会话
+    keepalive_task = None
+    if settings.redis_url:
+        session_store = RedisSessionStore(settings.redis_url, ttl=SESSION_IDLE_TTL)
+        keepalive_task = asyncio.create_task(redis_keepalive())
+        logger.info("Redis session store enabled")
+
+    yield
+
+    # 先取消未完成的异步聊天任务并等待退出，再关闭其依赖的连接
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+
+    sweep_task.cancel()
+    if session_store is not None:
+        keepalive_task.cancel()
+        await session_store.close()
+        session_store = None
+    await http_client.aclose()
+    http_client = None
+
+    # 恢复直接输出，再停止监听线程（停止前会输出队列中剩余的日志）
+    root_logger.removeHandler(log_queue_handler)
+    root_logger.addHandler(log_handler)
+    log_listener.stop()
+
+app = FastAPI(
+    title="Web Search Agent API",
+    lifespan=lifespan,
+    default_response_class=AppJSONResponse  # 优先orjson序列化，比标准库json快数倍
+)
+
+# 问答缓存：会话首轮的相同问题直接复用答案，跳过LLM调用（所有用户共享）
+response_cache = ResponseCache(ttl=3600)
+
+# 用户会话存储（进程内缓存，启用Redis时以Redis为准）
+# 限制会话数量并清理空闲会话，防止长期运行时内存无限增长
+SESSION_MAX_COUNT = 1000
+SESSION_IDLE_TTL = 3600
+SESSION_SWEEP_INTERVAL = 60
+user_sessions = SessionCache(
+    maxsize=SESSION_MAX_COUNT,
+    ttl=SESSION_IDLE_TTL,
+    is_pinned=lambda user_id: user_id in active_turns  # 进行中的对话不淘汰
+)
+
+# 每个会话保留的最大对话轮数（滑动窗口），限制长会话每次请求的prefill开销
+MAX_HISTORY_TURNS = 20
+
+# 会话锁：按user_id哈希分片，不同用户的会话操作互不阻塞
+SESSION_LOCK_SHARDS = 16
+session_locks = [asyncio.Lock() for _ in range(SESSION_LOCK_SHARDS)]
+
+# 本进程中进行中的对话轮数（按user_id计数），有进行中的对话时不从Redis覆盖内存历史
+active_turns: Dict[str, int] = {}
+
+# Redis会话存储
+REDIS_PING_INTERVAL = 30
+session_store = None
+
+# 异步聊天任务：限制并发执行数和排队任务数，并只保留最近的任务记录
+# 启用Redis时任务状态同时写入Redis（TASK_RESULT_TTL秒后过期），任意worker均可查询
+MAX_CONCURRENT_TASKS = 32
+MAX_PENDING_TASKS = 256
+MAX_RETAINED_TASKS = 1000
+TASK_RESULT_TTL = 3600
+task_semaphore = asyncio.Semaphore(MAX_CONCURRENT_TASKS)
+chat_tasks: Dict[str, Dict[str, Any]] = {}
+background_tasks: Set[asyncio.Task] = set()
+
+# 历史消息超过该条数时流式返回JSON
+HISTORY_STREAM_THRESHOLD = 200
+
+# SSE帧前后缀（预编码为bytes）
+DATA_PREFIX = b"data: "
+SSE_SEP = b"\n\n"
+
+# 已知事件类型：启动时为每种类型生成专用编码器（见make_sse_encoder），逐帧只序列化data部分
+SSE_EVENT_TYPES = (
+    "content", "tool_call_delta", "tool_call_complete", "done", "system_info",
+    "tool_execution_start", "tool_executing", "tool_result", "continue_generation",
+    "history", "error"
+)
+SSE_EVENT_SUFFIX = b"}" + SSE_SEP
+
+# SSE文本合并：刷新周期内连续到达的content片段合并为一帧发送
+# 流式输出超过SSE_SLOW_AFTER秒后放宽刷新周期，长回复时进一步减少帧数
+SSE_FLUSH_INTERVAL = 0.02
+SSE_FLUSH_INTERVAL_SLOW = 0.05
+SSE_SLOW_AFTER = 2.0
+
+# SSE心跳：长时间无输出时发送注释帧，防止Nginx等代理因空闲超时断开连接
+SSE_PING_INTERVAL = 15.0
+SSE_PING_FRAME = b": ping\n\n"
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+# 共享HTTP客户端（在lifespan中创建）
+http_client: Optional[httpx.AsyncClient] = None
 
 # ============================================
 # 核心函数
 # ============================================
 
-def get_or_create_user_session(user_id: str) -> LLM:
+def create_llm() -> LLM:
+    """创建LLM实例，复用共享HTTP客户端"""
+    settings = get_settings()
+    return LLM(
+        api_key=settings.deepseek_api_key,
+        base_url=settings.base_url,
+        model=settings.model,
+        http_client=http_client,
+        max_history_turns=MAX_HISTORY_TURNS
+    )
+
+async def get_user_session(user_id: str) -> Optional[LLM]:
+    """获取已有会话，不存在返回None（须在session_lock内调用）
+
+    启用Redis时从Redis同步历史，保证多worker间一致：仅当Redis中的版本与内存不同、
+    且本进程没有该用户进行中的对话时才覆盖内存历史，避免进行中的对话被旧历史替换。
+    LLM对象本身缓存在进程内，避免重复构建客户端。
+    """
+    llm = user_sessions.get(user_id)
+    if session_store is None or (llm is not None and active_turns.get(user_id)):
+        return llm
+
+    # 先只比较版本标识，版本一致时（常见情况）无需传输和解析完整历史
+    revision = await session_store.load_revision(user_id)
+    if revision is None:
+        return llm
+    if llm is None:
+        llm = user_sessions.setdefault(user_id, create_llm())
+    if llm.revision != revision:
+        stored = await session_store.load(user_id)
+        if stored is not None:
+            llm.restore_history(*stored)
+    return llm
+
+async def load_revision(user_id: str) -> Optional[str]:
+    """只读获取会话历史版本标识，不存在返回None
+
+    启用Redis时只读取版本字段，不传输、不解析历史；尚未保存的新会话回退到进程内会话。
+    """
+    if session_store is not None:
+        revision = await session_store.load_revision(user_id)
+        if revision is not None:
+            return revision
+    llm = user_sessions.get(user_id)
+    return None if llm is None else llm.revision
+
+async def load_history(user_id: str, limit: Optional[int] = None) -> Optional[Tuple[List[Dict], int, str]]:
+    """只读获取会话历史，返回(最近limit条消息, 消息总数, 版本标识)，不存在返回None
+
+    不修改进程内会话。启用Redis时优先返回Redis中已保存的历史，
+    尚未保存的新会话回退到进程内会话（只复制最近limit条）。
+    """
+    if session_store is not None:
+        stored = await session_store.load(user_id)
+        if stored is not None:
+            history, revision = stored
+            message_count = len(history)
+            if limit is not None:
+                history = history[-limit:] if limit > 0 else []
+            return history, message_count, revision
+    llm = user_sessions.get(user_id)
+    if llm is None:
+        return None
+    return llm.get_history(limit), len(llm.conversation_history), llm.revision
+
+def session_lock(user_id: str) -> asyncio.Lock:
+    """获取用户所在分片的会话锁"""
+    return session_locks[hash(user_id) % SESSION_LOCK_SHARDS]
+
+async def get_or_create_user_session(user_id: str) -> LLM:
     """获取或创建用户会话"""
-    if user_id not in user_sessions:
-        logger.info(f"Creating new session for user: {user_id}")
-        user_sessions[user_id] = LLM(**LLM_CONFIG)
-        # 添加系统提示词
-        user_sessions[user_id].add_message(
-            "system", 
-            "你是一个智能搜索助手，可以搜索最新的互联网信息来回答问题。"
+    # 加锁避免同一用户并发请求在等待Redis时重复创建会话
+    async with session_lock(user_id):
+        llm = await get_user_session(user_id)
+        if llm is None:
+            logger.info("Creating new session for user: %s", user_id)
+            llm = create_llm()
+            # 添加系统提示词
+            llm.add_message(
+                "system", 
+                "你是一个智能搜索助手，可以搜索最新的互联网信息来回答问题。"
+            )
+            llm = user_sessions.setdefault(user_id, llm)
+    return llm # 返回llm对象
+
+@asynccontextmanager
+async def user_turn(user_id: str) -> AsyncIterator[LLM]:
+    """一轮对话的会话上下文：获取会话并标记为进行中，结束后取消标记"""
+    llm = await get_or_create_user_session(user_id)
+    active_turns[user_id] = active_turns.get(user_id, 0) + 1
+    try:
+        yield llm
+    finally:
+        active_turns[user_id] -= 1
+        if not active_turns[user_id]:
+            del active_turns[user_id]
+
+async def save_user_session(user_id: str, llm: LLM):
+    """将会话历史写回Redis（未启用时忽略）"""
+    if session_store is not None:
+        await session_store.save(user_id, llm.conversation_history, llm.revision)
+
+async def sweep_sessions():
+    """定期清理空闲过期的会话"""
+    while True:
+        await asyncio.sleep(SESSION_SWEEP_INTERVAL)
+        user_sessions.expire()
+
+async def redis_keepalive():
+    """定期ping Redis，及早发现失效连接"""
+    while True:
+        await asyncio.sleep(REDIS_PING_INTERVAL)
+        await session_store.ping()
+
+def cache_context(llm: LLM, request: ChatRequest) -> Optional[str]:
+    """问答缓存的上下文键：系统提示词 + 影响回答的请求参数
+
+    只缓存会话首轮（历史中只有system消息）的问答：此时回答只取决于问题本身，
+    不同用户、清空历史后的相同问题都能命中；非首轮返回None，不查询也不写入缓存，
+    避免"为什么？"这类依赖上下文的追问复用其他对话中的回答。
+    """
+    history = llm.conversation_history
+    if any(msg["role"] != "system" for msg in history):
+        return None
+    system = "\n".join(msg["content"] for msg in history)
+    return f"{system}\n{request.temperature}:{request.max_tokens}:{request.max_tool_rounds}"
+
+def cache_turn(message: str, llm: LLM, start: int, context: Optional[str]):
+    """缓存本轮回答
+
+    搜索结果具有时效性，触发过工具调用的回答不缓存。
+    start为本轮开始前的历史长度，context为本轮开始前计算的缓存上下文（None表示不缓存）。
+    """
+    if context is None:
+        return
+    turn = llm.conversation_history[start:]
+    if any(msg["role"] == "tool" for msg in turn):
+        return
+    if turn and turn[-1]["role"] == "assistant" and turn[-1]["content"]:
+        response_cache.set(message, turn[-1]["content"], context)
+
+def chat_response(user_id: str, content: str, llm: LLM) -> Dict[str, Any]:
+    """构建非流式响应（结构同ChatResponse）
+
+    数据均来自内部，直接构建dict交给JSON响应直接序列化，省去Pydantic逐字段校验
+    """
+    return {
+        "user_id": user_id,
+        "content": content,
+        "conversation_history": llm.get_history(),
+        "status": "success"
+    }
+
+async def run_chat(request: ChatRequest) -> Dict[str, Any]:
+    """非流式对话：完成全部工具调用后返回完整回复"""
+    async with user_turn(request.user_id) as llm:
+        # 先裁剪历史再计算缓存上下文、记录本轮起点，保证二者在本轮内有效
+        llm.trim_history()
+        context = cache_context(llm, request)
+        cached = response_cache.get(request.message, context) if context is not None else None
+        if cached is not None:
+            # 缓存命中：补全历史后直接返回
+            llm.add_message("user", request.message)
+            llm.add_message("assistant", cached)
+            await save_user_session(request.user_id, llm)
+            return chat_response(request.user_id, cached, llm)
+
+        start = len(llm.conversation_history)
+        content = await llm.chat_complete(
+            user_input=request.message,
+            tools=tools,
+            tool_functions=tool_functions,
+            temperature=request.temperature,
+            max_tokens=request.max_tokens,
+            max_tool_rounds=request.max_tool_rounds,
+            verbose=True  # 开启详细日志
         )
-    return user_sessions[user_id] # 返回llm对象
+        cache_turn(request.message, llm, start, context)
+        await save_user_session(request.user_id, llm)
+        
+        return chat_response(request.user_id, content, llm)
+
+async def save_chat_task(task: Dict[str, Any]):
+    """将任务状态写入Redis（未启用时忽略）"""
+    if session_store is not None:
+        await session_store.save_task(task["task_id"], task, TASK_RESULT_TTL)
+
+async def run_chat_task(task_id: str, request: ChatRequest):
+    """后台执行聊天任务，并发数受 task_semaphore 限制"""
+    task = chat_tasks[task_id]
+    async with task_semaphore:
+        task["status"] = "running"
+        await save_chat_task(task)
+        try:
+            task["result"] = await run_chat(request)
+            task["status"] = "success"
+        except Exception as e:
+            logger.error("Task %s failed for user %s: %s", task_id, request.user_id, e)
+            task["status"] = "error"
+            task["error"] = str(e)
+        await save_chat_task(task)
+
+def prune_chat_tasks():
+    """超出保留上限时，从最早的任务开始清理已结束的任务记录"""
+    excess = len(chat_tasks) - MAX_RETAINED_TASKS
+    if excess <= 0:
+        return
+    finished = [
+        task_id for task_id, task in chat_tasks.items()
+        if task["status"] in ("success", "error")
+    ]
+    for task_id in finished[:excess]:
+        del chat_tasks[task_id]
+
+def make_sse_encoder(event_type: str) -> Callable[[Any], bytes]:
+    """生成指定事件类型的SSE编码器
+
+    固定部分 data: {"type":"...","data": 预先编码，编码器只需序列化data
+    """
+    prefix = DATA_PREFIX + b'{"type":"' + event_type.encode() + b'","data":'
+
+    def encode(data: Any, dumps=json_dumps, suffix=SSE_EVENT_SUFFIX) -> bytes:
+        return prefix + dumps(data) + suffix
+
+    return encode
+
+SSE_ENCODERS: Dict[str, Callable[[Any], bytes]] = {
+    event_type: make_sse_encoder(event_type) for event_type in SSE_EVENT_TYPES
+}
+
+def sse_frame(event: Dict[str, Any]) -> bytes:
+    """将事件编码为一帧SSE数据"""
+    encoder = SSE_ENCODERS.get(event["type"])
+    if encoder is None or len(event) != 2:
+        return DATA_PREFIX + json_dumps(event) + SSE_SEP
+    return encoder(event["data"])
+
+async def coalesce_content(events: AsyncIterator[Dict[str, Any]]) -> AsyncIterator[Optional[Dict[str, Any]]]:
+    """合并流式事件中连续的content片段
+
+    后台任务读取事件放入队列，前台按刷新周期把排队的content片段拼接成一个事件；
+    遇到其他类型事件时先发送已合并的文本，保证事件顺序不变。
+    空闲超过SSE_PING_INTERVAL秒（如等待工具执行）时产出None，由调用方发送心跳。
+    """
+    loop = asyncio.get_running_loop()
+    events_queue: asyncio.Queue = asyncio.Queue()
+    finished = object()
+
+    async def produce():
+        try:
+            async for event in events:
+                await events_queue.put(event)
+        except Exception as e:
+            await events_queue.put(e)
+        finally:
+            await events_queue.put(finished)
+
+    producer = asyncio.create_task(produce())
+    started = loop.time()
+    buffer: List[str] = []
+    deadline = None
+    try:
+        while True:
+            timeout = SSE_PING_INTERVAL if deadline is None else max(deadline - loop.time(), 0)
+            try:
+                item = await asyncio.wait_for(events_queue.get(), timeout)
+            except asyncio.TimeoutError:
+                if not buffer:
+                    # 长时间无事件，心跳保活
+                    yield None
+                    continue
+                # 刷新周期到，发送已合并的文本
+                yield {"type": "content", "data": "".join(buffer)}
+                buffer.clear()
+                deadline = None
+                continue
+
+            if isinstance(item, dict) and item["type"] == "content":
+                if not buffer:
+                    slow = loop.time() - started > SSE_SLOW_AFTER
+                    deadline = loop.time() + (SSE_FLUSH_INTERVAL_SLOW if slow else SSE_FLUSH_INTERVAL)
+                buffer.append(item["data"])
+                continue
+
+            if buffer:
+                yield {"type": "content", "data": "".join(buffer)}
+                buffer.clear()
+                deadline = None
+
+            if item is finished:
+                break
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        producer.cancel()
+
+async def stream_history_json(user_id: str, history: List[Dict], message_count: int) -> AsyncIterator[bytes]:
+    """逐条序列化历史，输出与非流式响应相同结构的JSON"""
+    yield b'{"user_id":' + json_dumps(user_id) + b',"history":['
+    for i, msg in enumerate(history):
+        yield (b"," if i else b"") + json_dumps(msg)
+    yield b'],"message_count":' + str(message_count).encode() + b"}"
 
 # ============================================
 # API端点
 # ============================================
 
-@app.post("/chat")
+@app.post("/chat", responses={200: {"model": ChatResponse}})
 async def chat(request: ChatRequest):
     """统一聊天端点"""
     try:
-        llm = get_or_create_user_session(request.user_id)
-        
-        if request.stream:
-            # 流式响应
-            async def generate():
-                try:
-                    async for chunk in llm.chat_stream(
+        if not request.stream:
+            # 非流式响应：直接返回JSON响应，跳过jsonable_encoder
+            return AppJSONResponse(await run_chat(request))
+
+        # 流式响应：会话在生成器内获取，整轮对话期间保持进行中标记
+        async def generate():
+            try:
+                async with user_turn(request.user_id) as llm:
+                    llm.trim_history()
+                    context = cache_context(llm, request)
+                    cached = response_cache.get(request.message, context) if context is not None else None
+                    if cached is not None:
+                        # 缓存命中：补全历史后直接返回
+                        llm.add_message("user", request.message)
+                        llm.add_message("assistant", cached)
+                        await save_user_session(request.user_id, llm)
+                        for chunk in (
+                            {"type": "content", "data": cached},
+                            {"type": "done", "data": {"content": cached, "tool_calls": None}}
+                        ):
+                            yield sse_frame(chunk)
+                        yield sse_frame({'type': 'history', 'data': llm.conversation_history})
+                        return
+
+                    start = len(llm.conversation_history)
+                    async for chunk in coalesce_content(llm.chat_stream(
                         user_input=request.message,
                         tools=tools,
                         tool_functions=tool_functions,
                         temperature=request.temperature,
                         max_tokens=request.max_tokens,
                         max_tool_rounds=request.max_tool_rounds
-                    ):
+                    )):
                         # 转换为SSE格式
-                        yield f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n" # json.dumps()：将 Python 字典转换为 JSON 字符串
+                        yield SSE_PING_FRAME if chunk is None else sse_frame(chunk) # 直接输出bytes，省去逐帧字符串拼接与编码
                     
+                    cache_turn(request.message, llm, start, context)
+                    await save_user_session(request.user_id, llm)
+
                     # 发送历史记录作为最后一个事件
-                    yield f"data: {json.dumps({'type': 'history', 'data': llm.get_history()}, ensure_ascii=False)}\n\n"
-                    
-                except Exception as e:
-                    logger.error(f"Stream error for user {request.user_id}: {e}")
-                    yield f"data: {json.dumps({'type': 'error', 'data': str(e)})}\n\n"
-                    
-            return StreamingResponse(generate(), media_type="text/event-stream")
-        
-        else:
-            # 非流式响应
-            content = await llm.chat_complete(
-                user_input=request.message,
-                tools=tools,
-                tool_functions=tool_functions,
-                temperature=request.temperature,
-                max_tokens=request.max_tokens,
-                max_tool_rounds=request.max_tool_rounds,
-                verbose=True  # 开启详细日志
-            )
-            
-            return ChatResponse(
-                user_id=request.user_id,
-                content=content,
-                conversation_history=llm.get_history()
-            )
+                    yield sse_frame({'type': 'history', 'data': llm.conversation_history})
+                
+            except Exception as e:
+                logger.error("Stream error for user %s: %s", request.user_id, e)
+                yield sse_frame({'type': 'error', 'data': str(e)})
+                
+        return StreamingResponse(
+            generate(),
+            media_type="text/event-stream",
+            headers=SSE_HEADERS
+        )
             
     except Exception as e:
-        logger.error(f"Chat error for user {request.user_id}: {e}")
+        logger.error("Chat error for user %s: %s", request.user_id, e)
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/chat/async")
+async def chat_async(request: ChatRequest):
+    """异步聊天：立即返回任务ID，通过 /chat/result/{task_id} 查询结果
+
+    排队任务数超过 MAX_PENDING_TASKS 时返回429
+    """
+    if len(background_tasks) >= MAX_PENDING_TASKS:
+        raise HTTPException(status_code=429, detail="Too many pending tasks")
+
+    task_id = uuid.uuid4().hex
+    record = {"task_id": task_id, "status": "pending"}
+    # 先写入pending状态再启动任务，保证其他worker立即可查且状态不会被回写覆盖
+    await save_chat_task(record)
+
+    # 写入Redis期间可能有其他请求占用了名额，启动前再检查一次
+    if len(background_tasks) >= MAX_PENDING_TASKS:
+        raise HTTPException(status_code=429, detail="Too many pending tasks")
+
+    chat_tasks[task_id] = record
+    prune_chat_tasks()
+
+    task = asyncio.create_task(run_chat_task(task_id, request))
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return {"task_id": task_id, "status": "pending"}
+
+@app.get("/chat/result/{task_id}")
+async def get_chat_result(task_id: str):
+    """查询异步聊天任务状态与结果
+
+    本worker执行的任务直接读取内存记录，否则从Redis查询
+    """
+    task = chat_tasks.get(task_id)
+    if task is None and session_store is not None:
+        task = await session_store.load_task(task_id)
+    if task is not None:
+        return AppJSONResponse(task)
+    raise HTTPException(status_code=404, detail="Task not found")
+
 @app.delete("/chat/{user_id}")
 async def clear_history(user_id: str):
     """清除用户历史"""
-    if user_id in user_sessions:
-        user_sessions[user_id].clear_history()
-        # 重新添加系统提示词
-        user_sessions[user_id].add_message(
-            "system", 
-            "你是一个智能搜索助手，可以搜索最新的互联网信息来回答问题。"
-        )
-        logger.info(f"History cleared for user: {user_id}")
-        return {"message": "History cleared", "user_id": user_id}
+    async with session_lock(user_id):
+        llm = await get_user_session(user_id)
+        if llm is not None:
+            llm.clear_history()
+            # 重新添加系统提示词
+            llm.add_message(
+                "system", 
+                "你是一个智能搜索助手，可以搜索最新的互联网信息来回答问题。"
+            )
+            await save_user_session(user_id, llm)
+            logger.info("History cleared for user: %s", user_id)
+            return AppJSONResponse({"message": "History cleared", "user_id": user_id})
     raise HTTPException(status_code=404, detail="User not found")
 
 @app.get("/chat/{user_id}/history") 
-async def get_history(user_id: str):
-    """获取用户历史"""
-    if user_id in user_sessions:
-        history = user_sessions[user_id].get_history()
-        return {
-            "user_id": user_id,
-            "history": history,
-            "message_count": len(history)
-        }
+async def get_history(user_id: str, request: Request, limit: Optional[int] = Query(None, ge=0)):
+    """获取用户历史，limit为最近消息条数（可选）
+
+    响应带有基于历史版本的ETag，客户端携带If-None-Match轮询时，
+    历史未变化直接返回304，跳过历史序列化。
+    """
+    # 只读路径：不修改进程内会话，避免覆盖进行中对话的历史
+    # 先只读取版本标识比对ETag，未变化时直接返回304，不加载历史
+    suffix = "all" if limit is None else limit
+    revision = await load_revision(user_id)
+    if revision is not None:
+        etag = f'W/"{revision}-{suffix}"'
+        if request.headers.get("if-none-match") == etag:
+            return Response(status_code=304, headers={"ETag": etag, "Cache-Control": "private, max-age=1"})
+
+    stored = await load_history(user_id, limit)
+    if stored is not None:
+        # 以实际加载到的历史版本生成ETag（两次读取之间历史可能已更新）
+        history, message_count, revision = stored
+        etag = f'W/"{revision}-{suffix}"'
+        headers = {"ETag": etag, "Cache-Control": "private, max-age=1"}
+
+        if len(history) > HISTORY_STREAM_THRESHOLD:
+            # 长历史逐条流式输出，内存占用只与单条消息相关
+            return StreamingResponse(
+                stream_history_json(user_id, history, message_count),
+                media_type="application/json",
+                headers=headers
+            )
+        return AppJSONResponse(
+            {
+                "user_id": user_id,
+                "history": history,
+                "message_count": message_count
+            },
+            headers=headers
+        )
     raise HTTPException(status_code=404, detail="User not found")
 
 @app.get("/")
@@ -163,6 +699,8 @@ async def root():
         "version": "1.0.0",
         "endpoints": [
             {"method": "POST", "path": "/chat", "description": "聊天接口"},
+            {"method": "POST", "path": "/chat/async", "description": "异步聊天接口"},
+            {"method": "GET", "path": "/chat/result/{task_id}", "description": "查询异步聊天结果"},
             {"method": "GET", "path": "/chat/{user_id}/history", "description": "获取历史"},
             {"method": "DELETE", "path": "/chat/{user_id}", "description": "清除历史"}
         ]
@@ -174,13 +712,27 @@ async def root():
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run("api_service:app", host="0.0.0.0", port=8000, reload=True)
+    # uvloop + httptools 需安装 uvicorn[standard]；warning级别关闭逐请求的访问日志
+    uvicorn.run("api_service:app", host="0.0.0.0", port=8000, reload=True,
+                loop="uvloop", http="httptools", log_level="warning")
 
 
 
 """
+## 环境变量
+DEEPSEEK_API_KEY=sk-...      # 必需
+TAVILY_API_KEY=tvly-...      # 搜索工具使用
+DEEPSEEK_BASE_URL / DEEPSEEK_MODEL / REDIS_URL 可选，见 config.py
+
 ## 命令行启动
-uvicorn api_service:app --reload --host 0.0.0.0 --port 8000
+pip install "uvicorn[standard]"
+uvicorn api_service:app --reload --host 0.0.0.0 --port 8000 --loop uvloop --http httptools --log-level warning
+
+## 多worker部署
+设置 REDIS_URL（如 redis://localhost:6379/0）后会话历史保存在Redis中，各worker共享
+未设置 REDIS_URL 时 gunicorn.conf.py 默认只启动单个worker（会话只保存在进程内）
+Redis中的会话空闲超过 SESSION_IDLE_TTL 秒自动过期；建议同时配置 maxmemory-policy allkeys-lru
+gunicorn api_service:app -c gunicorn.conf.py
 
 ## URL
 URL: http://localhost:8000/chat
@@ -203,8 +755,19 @@ Accept: text/event-stream
     "max_tool_rounds": 3
 }
 
+## POST 异步聊天
+URL: http://localhost:8000/chat/async
+请求体同上（忽略stream），立即返回 {"task_id": "...", "status": "pending"}
+
+## GET 查询异步聊天结果
+URL: http://localhost:8000/chat/result/{task_id}
+status: pending / running / success / error
+排队任务过多时返回429；启用Redis时可在任意worker查询
+
 ## GET 获取历史记录
 URL: http://localhost:8000/chat/user123/history
+只取最近N条: http://localhost:8000/chat/user123/history?limit=20
+轮询时携带 If-None-Match: <上次响应的ETag>，历史未变化返回304
 Content-Type: application/json
 
 ## DELETE 清除历史记录
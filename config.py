@@ -0,0 +1,46 @@
+"""
+服务配置
+从环境变量读取，进程内只解析一次
+"""
+
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Optional
+import os
+
+
+@dataclass(frozen=True)
+class Settings:
+    """服务配置（只读）
+
+    环境变量：
+        DEEPSEEK_API_KEY: DeepSeek API密钥（必需）
+        DEEPSEEK_BASE_URL: API地址
+        DEEPSEEK_MODEL: 模型名称
+        TAVILY_API_KEY: Tavily搜索API密钥
+        REDIS_URL: Redis地址，设置后启用Redis会话存储
+    """
+    deepseek_api_key: str
+    base_url: str = "https://api.deepseek.com/v1"
+    model: str = "deepseek-chat"
+    tavily_api_key: Optional[str] = None
+    redis_url: Optional[str] = None
+
+    @classmethod
+    def from_env(cls) -> "Settings":
+        api_key = os.getenv("DEEPSEEK_API_KEY")
+        if not api_key:
+            raise RuntimeError("未设置环境变量 DEEPSEEK_API_KEY")
+        return cls(
+            deepseek_api_key=api_key,
+            base_url=os.getenv("DEEPSEEK_BASE_URL", cls.base_url),
+            model=os.getenv("DEEPSEEK_MODEL", cls.model),
+            tavily_api_key=os.getenv("TAVILY_API_KEY"),
+            redis_url=os.getenv("REDIS_URL")
+        )
+
+
+@lru_cache(maxsize=1)
+def get_settings() -> Settings:
+    """获取配置单例，首次调用时解析环境变量"""
+    return Settings.from_env()
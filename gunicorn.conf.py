@@ -0,0 +1,30 @@
+"""
+Gunicorn 部署配置
+gunicorn api_service:app -c gunicorn.conf.py
+
+会话保存在进程内，未设置 REDIS_URL 时各worker的会话互不可见，
+因此只有设置了 REDIS_URL 才默认启用多worker
+"""
+
+import multiprocessing
+import os
+
+bind = os.getenv("BIND", "0.0.0.0:8000")
+
+# 每个worker运行一个uvicorn事件循环
+# 启用Redis会话存储时默认 2*CPU核数+1 个worker，否则默认单worker
+worker_class = "uvicorn.workers.UvicornWorker"
+default_workers = multiprocessing.cpu_count() * 2 + 1 if os.getenv("REDIS_URL") else 1
+workers = int(os.getenv("WEB_CONCURRENCY", default_workers))
+
+# 定期重启worker，限制长期运行时的内存增长
+max_requests = 10000
+max_requests_jitter = 500
+
+# 在master中预加载应用，worker共享只读数据（如工具schema）
+# 日志输出线程等进程级资源在应用lifespan中按worker创建
+preload_app = True
+
+# worker心跳超时：事件循环阻塞超过该时间未向master报告的worker会被重启
+# UvicornWorker下不限制单个请求（如多轮工具调用）的耗时
+timeout = 120
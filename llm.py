@@ -1,8 +1,20 @@
 from openai import AsyncOpenAI
+import httpx
 from openai.types.chat import ChatCompletionMessage
 from typing import List, Dict, Optional, Literal, Callable, AsyncGenerator, Any, Union
 import asyncio
 import json
+import logging
+import uuid
+
+logger = logging.getLogger(__name__)
+
+# 达到最大工具调用轮数时内部添加的总结引导提示（以user角色发送，但不属于用户输入）
+SUMMARY_PROMPT = (
+    "基于上述所有工具调用的结果，请综合分析并用自然、友好的语言回答用户的问题。"
+    "确保：1) 直接回答用户的原始问题 2) 包含所有相关信息 3) 语言简洁清晰。"
+    "不要提及工具调用的过程，直接给出答案。"
+)
 
 class LLM:
     """通用大模型类，支持OpenAI兼容的API（包括DeepSeek）
@@ -20,14 +32,20 @@ class LLM:
                  model: str = "deepseek-chat",
                  tool_choice: Literal["auto", "required", "none"] = "auto",
                  temperature: float = 1,
-                 max_tokens: int = 4096):
+                 max_tokens: int = 4096,
+                 http_client: Optional[httpx.AsyncClient] = None,
+                 max_history_turns: Optional[int] = None):
         
-        self.client = AsyncOpenAI(api_key=api_key, base_url=base_url)
+        # http_client: 可传入共享的httpx客户端，多个实例复用同一连接池
+        # max_history_turns: 历史保留的最大对话轮数，None表示不限制
+        self.client = AsyncOpenAI(api_key=api_key, base_url=base_url, http_client=http_client)
         self.model = model
         self.temperature = temperature
         self.max_tokens = max_tokens
         self.tool_choice = tool_choice
+        self.max_history_turns = max_history_turns
         self.conversation_history: List[Dict] = []
+        self.revision = uuid.uuid4().hex  # 历史版本标识，每次修改历史时更新
 
     # ============================================
     # 基础方法
@@ -78,12 +96,59 @@ class LLM:
             raise ValueError(f"未知的角色类型: {role}")
         
         self.conversation_history.append(msg)
+        self.revision = uuid.uuid4().hex
+
     def clear_history(self):
         """清空对话历史"""
         self.conversation_history = []
+        self.revision = uuid.uuid4().hex
+
+    def restore_history(self, history: List[Dict], revision: Optional[str] = None):
+        """恢复外部保存的对话历史（如从Redis加载）
+        
+        Args:
+            history: 对话历史
+            revision: 保存时的历史版本标识，缺省时生成新标识
+        """
+        self.conversation_history = history
+        self.revision = revision or uuid.uuid4().hex
+    
+    def trim_history(self):
+        """滑动窗口裁剪历史，限制每次请求的prefill长度
+
+        保留开头的system消息，其余历史以用户输入（不含内部总结提示）为轮次起点。
+        加上即将开始的新一轮会超过max_history_turns时，一次裁剪到最近的半个窗口，
+        两次裁剪之间历史只追加，请求前缀保持稳定，服务端前缀缓存可持续命中。
+        按轮次整体裁剪，assistant的tool_calls与对应的tool结果不会被拆开。
+        """
+        if not self.max_history_turns:
+            return
+
+        history = self.conversation_history
+        head = 0
+        while head < len(history) and history[head]["role"] == "system":
+            head += 1
+
+        turn_starts = [
+            i for i in range(head, len(history))
+            if history[i]["role"] == "user" and history[i]["content"] != SUMMARY_PROMPT
+        ]
+        if len(turn_starts) < self.max_history_turns:
+            return
+
+        keep = self.max_history_turns // 2
+        cut = turn_starts[-keep] if keep > 0 else len(history)
+        self.conversation_history = history[:head] + history[cut:]
+        self.revision = uuid.uuid4().hex
     
-    def get_history(self) -> List[Dict]:
-        """获取对话历史"""
+    def get_history(self, limit: Optional[int] = None) -> List[Dict]:
+        """获取对话历史
+        
+        Args:
+            limit: 只返回最近的limit条消息（可选），避免复制完整历史
+        """
+        if limit is not None:
+            return self.conversation_history[-limit:] if limit > 0 else []
         return self.conversation_history.copy()
 
     # ============================================
@@ -96,7 +161,11 @@ class LLM:
                             max_tokens: Optional[int] = None,
                             tool_choice: Optional[Literal["auto", "required", "none"]] = None,
                             stream: bool = False) -> Dict:
-        """构建API请求参数 - 简化版"""
+        """构建API请求参数 - 简化版
+
+        历史只追加、不改写已有消息，仅在超过max_history_turns时一次性裁剪半个窗口（见trim_history），
+        两次裁剪之间每轮请求的前缀与上一轮保持一致，DeepSeek服务端的上下文硬盘缓存可自动命中（无需额外参数）
+        """
         
         params = {
             "model": self.model,
@@ -114,7 +183,8 @@ class LLM:
 
     async def _execute_tool(self,
                           tool_call: Dict,
-                          tool_functions: Dict[str, Callable]) -> tuple[str, str]:
+                          tool_functions: Dict[str, Callable],
+                          func_args: Optional[Dict] = None) -> tuple[str, str]:
         """执行单个工具调用 - 统一工具执行逻辑
         
         处理assistant角色返回的tool_call，执行对应的工具函数并返回结果。
@@ -150,6 +220,8 @@ class LLM:
                     "search_web": search_web_func,
                     "calculate": calculate_func
                 }
+            
+            func_args (Optional[Dict]): 已解析的参数（可选），调用方已解析过时传入，避免重复json.loads
         
         Returns:
             tuple[str, str]: 返回元组 (函数名称, 执行结果)
@@ -162,7 +234,8 @@ class LLM:
         """
         
         func_name = tool_call["function"]["name"]
-        func_args = json.loads(tool_call["function"]["arguments"])
+        if func_args is None:
+            func_args = json.loads(tool_call["function"]["arguments"])
         
         if func_name in tool_functions:
             # 判断是否为异步函数并执行
@@ -200,7 +273,7 @@ class LLM:
             temperature: 温度参数
             max_tokens: 最大tokens
             tool_choice: 工具选择模式
-            verbose: 是否打印详细信息
+            verbose: 是否记录详细日志
             max_tool_rounds: 最大工具调用轮数（默认3轮）
             _current_round: 内部参数，当前递归轮数
             
@@ -210,6 +283,7 @@ class LLM:
         
         # 只在有用户输入时添加（第一轮）
         if user_input:
+            self.trim_history()
             self.add_message("user", user_input)
         
         # 确保有消息可发送
@@ -221,17 +295,10 @@ class LLM:
             # 达到上限，准备生成最终总结
             tool_choice = "none"
             
-            # 内部配置的总结引导提示
-            summary_prompt = (
-                "基于上述所有工具调用的结果，请综合分析并用自然、友好的语言回答用户的问题。"
-                "确保：1) 直接回答用户的原始问题 2) 包含所有相关信息 3) 语言简洁清晰。"
-                "不要提及工具调用的过程，直接给出答案。"
-            )
-            
             # 添加总结引导提示
-            self.add_message("user", summary_prompt)
+            self.add_message("user", SUMMARY_PROMPT)
             if verbose:
-                print(f"[系统]: 达到最大工具调用轮数({max_tool_rounds})，添加总结引导...")
+                logger.info("[系统]: 达到最大工具调用轮数(%s)，添加总结引导...", max_tool_rounds)
         
         # 构建请求参数
         request_params = self._build_request_params(
@@ -245,6 +312,12 @@ class LLM:
         # API调用
         response = await self.client.chat.completions.create(**request_params)
         message = response.choices[0].message
+
+        if verbose and response.usage:
+            # DeepSeek在usage中返回前缀缓存命中情况，其他兼容API可能没有该字段
+            cache_hit = getattr(response.usage, "prompt_cache_hit_tokens", None)
+            if cache_hit is not None:
+                logger.info("[缓存]: 命中 %s/%s prompt tokens", cache_hit, response.usage.prompt_tokens)
         
         # 提取工具调用（如果有）
         tool_calls = None
@@ -269,15 +342,15 @@ class LLM:
         if not tool_calls or not tool_functions:
             if verbose:
                 if message.content:
-                    print(f"[助手]: {message.content}")
+                    logger.info("[助手]: %s", message.content)
                 if _current_round > 0:
-                    print(f"[系统]: 完成，共进行了 {_current_round} 轮工具调用")
+                    logger.info("[系统]: 完成，共进行了 %s 轮工具调用", _current_round)
             
             return message.content or ""
         
         # 执行工具调用
         if verbose:
-            print(f"[执行工具调用 - 第{_current_round + 1}轮]:")
+            logger.info("[执行工具调用 - 第%s轮]:", _current_round + 1)
         
         for tool_call in message.tool_calls:
             # 执行工具
@@ -287,9 +360,9 @@ class LLM:
             )
             
             if verbose:
-                print(f"  - 工具: {func_name}")
+                logger.info("  - 工具: %s", func_name)
                 result_display = result[:100] + "..." if len(result) > 100 else result
-                print(f"    结果: {result_display}")
+                logger.info("    结果: %s", result_display)
             
             # 添加工具结果到历史
             self.add_message("tool", content=result, tool_call_id=tool_call.id)
@@ -325,6 +398,8 @@ class LLM:
         """
         流式对话 - 支持多轮工具调用
         
+        必须保持为异步生成器（API层在启动时检查），否则StreamingResponse会退化为线程池逐块执行
+        
         Args:
             user_input: 用户输入（可选）
             tools: 工具schema列表
@@ -341,6 +416,7 @@ class LLM:
         
         # 只在有用户输入时添加（第一轮）
         if user_input:
+            self.trim_history()
             self.add_message("user", user_input)
         
         # 确保有消息可发送
@@ -352,12 +428,7 @@ class LLM:
             tool_choice = "none"
             
             # 添加总结引导提示
-            summary_prompt = (
-                "基于上述所有工具调用的结果，请综合分析并用自然、友好的语言回答用户的问题。"
-                "确保：1) 直接回答用户的原始问题 2) 包含所有相关信息 3) 语言简洁清晰。"
-                "不要提及工具调用的过程，直接给出答案。"
-            )
-            self.add_message("user", summary_prompt)
+            self.add_message("user", SUMMARY_PROMPT)
             
             yield {"type": "system_info", "data": f"达到最大工具调用轮数({max_tool_rounds})，生成最终答案..."}
         
@@ -393,7 +464,7 @@ class LLM:
                         }
                         
                         # 执行工具
-                        _, result = await self._execute_tool(tool_call, tool_functions)
+                        _, result = await self._execute_tool(tool_call, tool_functions, func_args)
                         
                         # 添加工具结果到历史
                         self.add_message("tool", content=result, tool_call_id=tool_call["id"])
@@ -474,7 +545,10 @@ class LLM:
                                 standard_call = {
                                     "id": current_tool_call["id"],
                                     "type": current_tool_call["type"],
-                                    "function": current_tool_call["function"]
+                                    "function": {
+                                        "name": current_tool_call["function"]["name"],
+                                        "arguments": "".join(current_tool_call["arguments_buf"])
+                                    }
                                 }
                                 collected_tool_calls.append(standard_call)
                                 yield {"type": "tool_call_complete", "data": standard_call}
@@ -483,14 +557,15 @@ class LLM:
                                 "id": tool_call.id or "",
                                 "type": "function",
                                 "index": tool_call.index,
-                                "function": {"name": "", "arguments": ""}
+                                "function": {"name": ""},
+                                "arguments_buf": []  # 参数片段，工具调用完成时一次性拼接
                             }
                     
                     if tool_call.function and tool_call.function.name:
                         current_tool_call["function"]["name"] = tool_call.function.name
                     
                     if tool_call.function and tool_call.function.arguments:
-                        current_tool_call["function"]["arguments"] += tool_call.function.arguments
+                        current_tool_call["arguments_buf"].append(tool_call.function.arguments)
                         yield {
                             "type": "tool_call_delta",
                             "data": {
@@ -504,7 +579,10 @@ class LLM:
             standard_call = {
                 "id": current_tool_call["id"],
                 "type": current_tool_call["type"],
-                "function": current_tool_call["function"]
+                "function": {
+                    "name": current_tool_call["function"]["name"],
+                    "arguments": "".join(current_tool_call["arguments_buf"])
+                }
             }
             collected_tool_calls.append(standard_call)
             yield {"type": "tool_call_complete", "data": standard_call}
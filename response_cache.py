@@ -0,0 +1,61 @@
+"""
+问答响应缓存
+命中时直接复用历史答案，跳过LLM往返
+"""
+
+from collections import OrderedDict
+from typing import Optional, Tuple
+import time
+import unicodedata
+
+
+class ResponseCache:
+    """会话首轮问答缓存（所有用户共享）
+
+    以上下文和归一化后的问题文本为键（统一全半角、忽略大小写和空白），
+    使"今天天气怎么样？"与"今天 天气怎么样?"命中同一条缓存。
+    标点保留不动，避免"2-3"与"23"这类不同问题被合并。
+    上下文由调用方提供（如系统提示词与请求参数），只应缓存不依赖对话历史的问答。
+
+    Args:
+        ttl: 缓存有效期（秒）
+        maxsize: 最多缓存的条目数，超出时淘汰最久未使用的条目
+    """
+
+    def __init__(self, ttl: float = 3600, maxsize: int = 1024):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._entries: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+
+    @staticmethod
+    def _normalize(message: str) -> str:
+        """归一化问题文本：统一全半角、小写，去掉空白"""
+        text = unicodedata.normalize("NFKC", message).lower()
+        return "".join(ch for ch in text if not ch.isspace())
+
+    def get(self, message: str, context: str = "") -> Optional[str]:
+        """查询缓存，未命中或已过期返回None"""
+        key = f"{context}\n{self._normalize(message)}"
+        item = self._entries.get(key)
+        if item is None:
+            return None
+
+        expires_at, content = item
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            return None
+
+        self._entries.move_to_end(key)
+        return content
+
+    def set(self, message: str, content: str, context: str = ""):
+        """写入缓存"""
+        text = self._normalize(message)
+        if not text or not content:
+            return
+
+        key = f"{context}\n{text}"
+        self._entries[key] = (time.monotonic() + self.ttl, content)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
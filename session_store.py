@@ -0,0 +1,194 @@
+"""
+会话存储
+进程内LRU+TTL会话缓存，以及基于Redis的跨worker会话持久化
+"""
+
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Tuple
+import json
+import logging
+import time
+
+try:
+    import redis.asyncio as redis
+except ImportError:  # 未安装redis时只能使用进程内会话缓存
+    redis = None
+
+logger = logging.getLogger(__name__)
+
+
+class SessionCache:
+    """进程内会话缓存（LRU + TTL）
+
+    按最近访问时间排序：超过maxsize时淘汰最久未访问的会话，
+    超过ttl秒未访问的会话在下次访问或调用expire()时移除。
+    正在使用的会话（is_pinned返回True）不会被淘汰，视为刚被访问；
+    全部会话都在使用时允许暂时超出maxsize。
+
+    Args:
+        maxsize: 最大会话数
+        ttl: 会话空闲过期时间（秒）
+        on_evict: 会话被淘汰时的回调，参数为(key, value)
+        is_pinned: 判断会话是否正在使用的回调，参数为key
+    """
+
+    def __init__(self,
+                 maxsize: int = 1000,
+                 ttl: float = 3600,
+                 on_evict: Optional[Callable[[str, Any], None]] = None,
+                 is_pinned: Optional[Callable[[str], bool]] = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.on_evict = on_evict
+        self.is_pinned = is_pinned
+        self._data: "OrderedDict[str, Tuple[float, Any]]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: str) -> Optional[Any]:
+        """获取会话并刷新访问时间，不存在或已过期返回None"""
+        item = self._data.get(key)
+        if item is None:
+            return None
+
+        now = time.monotonic()
+        last_access, value = item
+        if now - last_access > self.ttl and not self._pinned(key):
+            del self._data[key]
+            self._evict(key, value, "expired")
+            return None
+
+        self._data[key] = (now, value)
+        self._data.move_to_end(key)
+        return value
+
+    def setdefault(self, key: str, value: Any) -> Any:
+        """会话已存在则返回已有值，否则写入value"""
+        existing = self.get(key)
+        if existing is not None:
+            return existing
+
+        self._data[key] = (time.monotonic(), value)
+        skipped = 0
+        while len(self._data) > self.maxsize and skipped < len(self._data):
+            old_key, (_, old_value) = next(iter(self._data.items()))
+            if old_key == key or self._pinned(old_key):
+                self._touch(old_key, old_value)
+                skipped += 1
+                continue
+            del self._data[old_key]
+            self._evict(old_key, old_value, "capacity")
+        return value
+
+    def pop(self, key: str, default: Any = None) -> Any:
+        """移除会话（不触发淘汰回调）"""
+        item = self._data.pop(key, None)
+        return default if item is None else item[1]
+
+    def expire(self) -> int:
+        """清理所有已过期会话，返回清理数量"""
+        deadline = time.monotonic() - self.ttl
+        count = 0
+        # 按访问时间有序，遇到第一个未过期的即可停止
+        while self._data:
+            key, (last_access, value) = next(iter(self._data.items()))
+            if last_access >= deadline:
+                break
+            if self._pinned(key):
+                # 刷新后排到队尾，访问时间晚于deadline，循环必然结束
+                self._touch(key, value)
+                continue
+            del self._data[key]
+            self._evict(key, value, "expired")
+            count += 1
+        return count
+
+    def _pinned(self, key: str) -> bool:
+        return self.is_pinned is not None and self.is_pinned(key)
+
+    def _touch(self, key: str, value: Any):
+        """刷新访问时间并移到队尾"""
+        self._data[key] = (time.monotonic(), value)
+        self._data.move_to_end(key)
+
+    def _evict(self, key: str, value: Any, reason: str):
+        logger.info("Session evicted (%s): %s", reason, key)
+        if self.on_evict:
+            self.on_evict(key, value)
+
+
+class RedisSessionStore:
+    """Redis会话存储
+
+    每个用户对应一个哈希 session:{user_id}：
+    history字段保存JSON格式的对话历史，revision字段保存历史版本标识。
+    每次写入都会刷新键的过期时间，空闲超过ttl秒的会话由Redis自动删除。
+    异步聊天任务的状态保存在 task:{task_id} 中，供任意worker查询。
+    所有请求共享同一个连接池。
+
+    Args:
+        url: Redis连接地址，如 redis://localhost:6379/0
+        max_connections: 连接池最大连接数
+        ttl: 会话空闲过期时间（秒），None表示永不过期
+    """
+
+    def __init__(self, url: str, max_connections: int = 20, ttl: Optional[int] = None):
+        if redis is None:
+            raise ImportError("启用Redis会话存储需要安装redis: pip install redis")
+        pool = redis.ConnectionPool.from_url(
+            url,
+            max_connections=max_connections,
+            decode_responses=True
+        )
+        self.client = redis.Redis.from_pool(pool)
+        self.ttl = ttl
+
+    @staticmethod
+    def _key(user_id: str) -> str:
+        return f"session:{user_id}"
+
+    async def load(self, user_id: str) -> Optional[Tuple[List[Dict], Optional[str]]]:
+        """读取对话历史及其版本标识，不存在返回None"""
+        data, revision = await self.client.hmget(self._key(user_id), "history", "revision")
+        return (json.loads(data), revision) if data else None
+
+    async def load_revision(self, user_id: str) -> Optional[str]:
+        """只读取历史版本标识（不传输、不解析历史），不存在返回None"""
+        return await self.client.hget(self._key(user_id), "revision")
+
+    async def save(self, user_id: str, history: List[Dict], revision: str):
+        """写入对话历史及其版本标识，并刷新过期时间"""
+        key = self._key(user_id)
+        async with self.client.pipeline(transaction=True) as pipe:
+            pipe.hset(
+                key,
+                mapping={
+                    "history": json.dumps(history, ensure_ascii=False),
+                    "revision": revision
+                }
+            )
+            if self.ttl is not None:
+                pipe.expire(key, self.ttl)
+            await pipe.execute()
+
+    async def save_task(self, task_id: str, task: Dict, ttl: int):
+        """写入异步聊天任务状态，ttl秒后自动删除"""
+        await self.client.set(f"task:{task_id}", json.dumps(task, ensure_ascii=False), ex=ttl)
+
+    async def load_task(self, task_id: str) -> Optional[Dict]:
+        """读取异步聊天任务状态，不存在返回None"""
+        data = await self.client.get(f"task:{task_id}")
+        return json.loads(data) if data else None
+
+    async def ping(self) -> bool:
+        """检查连接是否可用"""
+        try:
+            return await self.client.ping()
+        except redis.RedisError as e:
+            logger.warning("Redis ping failed: %s", e)
+            return False
+
+    async def close(self):
+        """关闭连接池"""
+        await self.client.aclose()
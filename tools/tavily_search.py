@@ -1,9 +1,23 @@
 import logging
+from functools import lru_cache
 from typing import Optional, Literal
-from tavily import TavilyClient
+from tavily import AsyncTavilyClient
+
+from config import get_settings
 
 logger = logging.getLogger(__name__)
 
+@lru_cache(maxsize=1)
+def get_tavily_client() -> AsyncTavilyClient:
+    """Tavily异步客户端单例，所有搜索调用共享
+
+    使用异步客户端，搜索请求不会阻塞事件循环
+    """
+    api_key = get_settings().tavily_api_key
+    if not api_key:
+        raise ValueError("未设置环境变量 TAVILY_API_KEY")
+    return AsyncTavilyClient(api_key)
+
 async def tavily_search(
     query: str,
     max_results: int = 3,
@@ -13,7 +27,7 @@ async def tavily_search(
 ) -> str:
     """Tavily异步网络搜索"""
     try:
-        client = TavilyClient("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")
+        client = get_tavily_client()
         
         # 构建参数
         params = {
@@ -25,7 +39,7 @@ async def tavily_search(
         if time_range:
             params["time_range"] = time_range
         
-        response = client.search(**params)
+        response = await client.search(**params)
         
         # 提取结果
         answer = response.get("answer", "")
@@ -53,5 +67,5 @@ async def tavily_search(
         return '\n'.join(output)
         
     except Exception as e:
-        logger.error(f"搜索错误: {e}")
+        logger.error("搜索错误: %s", e)
         return f"搜索失败：{str(e)}"
\ No newline at end of file